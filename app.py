@@ -1,149 +1,241 @@
 import streamlit as st
-import time
-import json
-import random
+import asyncio
+import concurrent.futures
+import re
+import logging
 from datetime import datetime
-from typing import Dict, List, Tuple
-from openai import OpenAI
-from PIL import Image
-import requests
-from io import BytesIO
-
-class RateLimitHandler:
-    def __init__(self):
-        self.last_request_time = 0
-        self.min_delay = 2
-        self.max_delay = 30
-        self.base_delay = 5
-        self.max_retries = 3
-
-    def wait(self):
-        current_time = time.time()
-        elapsed = current_time - self.last_request_time
-        
-        if elapsed < self.min_delay:
-            time.sleep(self.min_delay - elapsed + random.uniform(0.1, 1.0))
-        
-        self.last_request_time = time.time()
-
-    def handle_rate_limit(self, attempt: int):
-        if attempt >= self.max_retries:
-            raise Exception("Max retries exceeded")
-        
-        delay = min(self.base_delay * (2 ** attempt), self.max_delay)
-        delay += random.uniform(0.1, 2.0)
-        
-        st.warning(f"Rate limit hit. Waiting {delay:.2f} seconds before retry...")
-        time.sleep(delay)
-
-rate_limiter = RateLimitHandler()
-
-def initialize_together_client() -> OpenAI:
-    return OpenAI(
+from typing import Dict, List, Optional, Tuple
+from openai import AsyncOpenAI, RateLimitError
+import orjson
+
+from async_runtime import run_async, submit
+import llm_cache
+from rate_limit import rate_limiter
+import semantic_cache
+
+logger = logging.getLogger(__name__)
+
+TEXT_MODEL = "meta-llama/Llama-Vision-Free"
+IMAGE_MODEL = "black-forest-labs/FLUX.1-schnell-Free"
+# Generated image URLs are short-lived, so they are not kept as long as text
+IMAGE_URL_TTL = 3600
+
+STORY_PROMPTS_INSTRUCTIONS = """Create 3 stories about the topic given by the user.
+For each story write a story line, an image prompt describing its scene, and
+a short story (100 words) that combines the story line with the scene. Make
+each story vivid and descriptive, as if describing a scene from a painting.
+Return only a JSON array with this structure:
+[
+    {"story_line": "story_line_1", "image_prompt": "image_prompt_1", "story": "story_1"},
+    {"story_line": "story_line_2", "image_prompt": "image_prompt_2", "story": "story_2"},
+    {"story_line": "story_line_3", "image_prompt": "image_prompt_3", "story": "story_3"}
+]"""
+
+STORY_FIELDS = ("story_line", "image_prompt", "story")
+
+# Models often wrap JSON answers in ```json fences despite the instructions
+JSON_FENCE_PATTERN = re.compile(r"^```(?:json)?\s*|\s*```$")
+
+@st.cache_resource
+def initialize_together_client() -> AsyncOpenAI:
+    # SDK retries are disabled so safe_api_call is the only retry policy
+    return AsyncOpenAI(
         api_key=st.secrets["TOGETHER_API_KEY"],
-        base_url="https://api.together.xyz/v1"
+        base_url="https://api.together.xyz/v1",
+        max_retries=0
     )
 
-def safe_api_call(func, *args, **kwargs):
+def parse_retry_after(error: RateLimitError) -> Optional[float]:
+    # Only the delay forms are used; HTTP dates fall back to backoff
+    headers = error.response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return max(float(headers["retry-after-ms"]) / 1000, 0.0)
+        return max(float(headers["retry-after"]), 0.0)
+    except (KeyError, ValueError):
+        return None
+
+async def safe_api_call(func, *args, **kwargs):
     for attempt in range(rate_limiter.max_retries):
         try:
-            rate_limiter.wait()
-            return func(*args, **kwargs)
-        except Exception as e:
-            if "429" in str(e) and attempt < rate_limiter.max_retries - 1:
-                rate_limiter.handle_rate_limit(attempt)
+            async with rate_limiter.semaphore:
+                await rate_limiter.wait()
+                return await func(*args, **kwargs)
+        except RateLimitError as e:
+            if attempt < rate_limiter.max_retries - 1:
+                await rate_limiter.handle_rate_limit(attempt, parse_retry_after(e))
                 continue
-            raise e
+            raise
     raise Exception("Max retries exceeded")
 
-def generate_story_prompts(client: OpenAI, topic: str) -> Dict[str, str]:
-    prompt = {
-        "role": "user",
-        "content": f"""Create 3 story lines and image prompts about: {topic}
-        Return only a JSON object with this structure:
-        {{
-            "story_line_1": "image_prompt_1",
-            "story_line_2": "image_prompt_2",
-            "story_line_3": "image_prompt_3"
-        }}"""
-    }
-
-    def make_request():
-        response = client.chat.completions.create(
-            model="meta-llama/Llama-Vision-Free",
-            messages=[prompt]
+async def _lookup_or_call(func, key: str, ttl: int):
+    # SQLite work runs in a worker thread so it never blocks the event loop
+    # that serves every session. The cache is only an optimization: read and
+    # write failures are logged, and a paid response is always returned
+    try:
+        cached = await asyncio.to_thread(llm_cache.get, key)
+    except Exception:
+        logger.exception("Response cache lookup failed")
+        cached = None
+    if cached is not None:
+        return cached
+
+    result = await safe_api_call(func)
+    try:
+        await asyncio.to_thread(llm_cache.set, key, result, ttl)
+    except Exception:
+        logger.exception("Response cache write failed")
+    return result
+
+async def cached_api_call(func, model: str, messages, ttl: int = llm_cache.DEFAULT_TTL):
+    # Identical requests are answered from the local cache without touching
+    # the rate limiter or the network. The in-flight check and registration
+    # happen before any await, so concurrent identical requests always share
+    # one lookup and at most one API call
+    key = llm_cache.make_key(model, messages)
+    task = llm_cache.inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_lookup_or_call(func, key, ttl))
+        llm_cache.inflight[key] = task
+        task.add_done_callback(lambda _: llm_cache.inflight.pop(key, None))
+
+    # Shielded so one cancelled caller does not cancel the request for the rest
+    return await asyncio.shield(task)
+
+def parse_json_response(content: str):
+    return orjson.loads(JSON_FENCE_PATTERN.sub("", content.strip()))
+
+def is_valid_story_prompts(story_prompts) -> bool:
+    return (
+        isinstance(story_prompts, list)
+        and len(story_prompts) > 0
+        and all(
+            isinstance(story_prompt, dict)
+            and all(isinstance(story_prompt.get(field), str) for field in STORY_FIELDS)
+            for story_prompt in story_prompts
+        )
+    )
+
+async def generate_story_prompts(client: AsyncOpenAI, topic: str) -> List[Dict[str, str]]:
+    # The instructions stay byte-identical across calls and the topic comes
+    # last, so the provider's prompt cache can reuse the shared prefix
+    messages = [
+        {"role": "system", "content": STORY_PROMPTS_INSTRUCTIONS},
+        {"role": "user", "content": topic},
+    ]
+
+    async def make_request():
+        response = await client.chat.completions.create(
+            model=TEXT_MODEL,
+            messages=messages
         )
-        return json.loads(response.choices[0].message.content)
+        story_prompts = parse_json_response(response.choices[0].message.content)
+        # Raising here keeps a malformed answer out of the response cache
+        if not is_valid_story_prompts(story_prompts):
+            raise ValueError("Unexpected story format returned by the model")
+        return story_prompts
 
-    return safe_api_call(make_request)
+    return await cached_api_call(make_request, TEXT_MODEL, messages)
 
-def generate_image(client: OpenAI, prompt: str) -> str:
-    def make_request():
-        response = client.images.generate(
-            model="black-forest-labs/FLUX.1-schnell-Free",
+async def generate_image(client: AsyncOpenAI, prompt: str) -> str:
+    async def make_request():
+        response = await client.images.generate(
+            model=IMAGE_MODEL,
             prompt=prompt,
         )
         return response.data[0].url
 
-    return safe_api_call(make_request)
+    return await cached_api_call(make_request, IMAGE_MODEL, prompt, ttl=IMAGE_URL_TTL)
 
-def generate_story(client: OpenAI, image_prompt: str, story_line: str) -> str:
-    prompt = f"""Write a short story (100 words) that combines these elements:
-    1. Scene description: {image_prompt}
-    2. Story line: {story_line}
-    Make the story vivid and descriptive, as if describing a scene from a painting."""
+class StoryGenerationError(Exception):
+    def __init__(self, results: List[Tuple[str, str, str]], errors: List[str]):
+        super().__init__("; ".join(errors))
+        self.results = results
+        self.errors = errors
 
-    def make_request():
-        response = client.chat.completions.create(
-            model="meta-llama/Llama-Vision-Free",
-            messages=[{"role": "user", "content": prompt}]
-        )
-        return response.choices[0].message.content
+async def generate_stories(client: AsyncOpenAI, story_prompts: List[Dict[str, str]]) -> List[Tuple[str, str, str]]:
+    # Story lines, image prompts and story text already came from one
+    # completion; only the images need a request per story. Stories that
+    # share an image prompt share one generated image
+    unique_prompts = list(dict.fromkeys(story_prompt["image_prompt"] for story_prompt in story_prompts))
+    unique_urls = await asyncio.gather(
+        *(generate_image(client, image_prompt) for image_prompt in unique_prompts),
+        return_exceptions=True
+    )
+    urls_by_prompt = dict(zip(unique_prompts, unique_urls))
+
+    results = []
+    errors = []
+    for i, story_prompt in enumerate(story_prompts, 1):
+        image_url = urls_by_prompt[story_prompt["image_prompt"]]
+        if isinstance(image_url, Exception):
+            errors.append(f"Error processing story {i}: {str(image_url)}")
+            continue
 
-    return safe_api_call(make_request)
+        results.append((image_url, story_prompt["story_line"], story_prompt["story"]))
 
-def create_multi_story_app(client: OpenAI, topic: str, progress_bar) -> List[Tuple[str, str, str]]:
+    # Partial results travel with their errors so the caller can show both
+    if errors:
+        raise StoryGenerationError(results, errors)
+    return results
+
+# Coroutines cannot be memoized by st.cache_data, so the cache sits on this
+# synchronous wrapper; the client is skipped when hashing arguments. Only the
+# text is cached here: image URLs are short-lived and already cached by
+# llm_cache for IMAGE_URL_TTL, which a second cache layer would extend
+@st.cache_data(ttl=3600, show_spinner=False)
+def cached_story_prompts(_client: AsyncOpenAI, topic: str) -> List[Dict[str, str]]:
+    return run_async(generate_story_prompts(_client, topic))
+
+def run_with_rate_limit_notice(coro, notice):
+    # Polls from the script thread, since the coroutine itself runs on the
+    # shared loop and cannot draw Streamlit elements
+    future = submit(coro)
     try:
-        progress_bar.progress(0.1, "Generating story prompts...")
-        story_prompts = generate_story_prompts(client, topic)
-        
-        results = []
-        for i, (story_line, image_prompt) in enumerate(story_prompts.items(), 1):
+        while True:
             try:
-                # Adjust progress calculations for 3 stories
-                progress_value = 0.1 + (i-1)*0.3
-                progress_bar.progress(progress_value, f"Generating image {i}...")
-                image_url = generate_image(client, image_prompt)
+                return future.result(timeout=0.5)
+            except concurrent.futures.TimeoutError:
+                if rate_limiter.retries_waiting:
+                    notice.info("Waiting on the API rate limit before retrying...")
+                else:
+                    notice.empty()
+    finally:
+        notice.empty()
 
-                progress_bar.progress(progress_value + 0.1, f"Generating story {i}...")
-                story = generate_story(client, image_prompt, story_line)
-
-                results.append((image_url, story_line, story))
+def create_multi_story_app(client: AsyncOpenAI, topic: str, progress_bar) -> List[Tuple[str, str, str]]:
+    notice = st.empty()
+    try:
+        # The text step runs inside st.cache_data, which would replay any
+        # notice drawn there, so it only gets a generic hint up front
+        progress_bar.progress(0.1, "Writing stories (this can pause if the API rate limit is hit)...")
+        story_prompts = cached_story_prompts(client, semantic_cache.canonical_topic(topic))
 
-            except Exception as e:
-                st.error(f"Error processing story {i}: {str(e)}")
-                continue
+        progress_bar.progress(0.5, "Generating images...")
+        results = run_with_rate_limit_notice(generate_stories(client, story_prompts), notice)
 
-        progress_bar.progress(1.0, "Complete!")
-        return results
+    except StoryGenerationError as e:
+        for error in e.errors:
+            st.error(error)
+        results = e.results
 
     except Exception as e:
         st.error(f"Error in story generation process: {str(e)}")
         return []
 
+    progress_bar.progress(1.0, "Complete!")
+    return results
+
 def display_story(image_url: str, story_line: str, story: str, index: int):
     st.subheader(f"Story {index}")
     
     col1, col2 = st.columns([1, 1])
     
     with col1:
-        try:
-            response = requests.get(image_url)
-            img = Image.open(BytesIO(response.content))
-            st.image(img, caption=f"Generated Image {index}", use_column_width=True)
-        except Exception as e:
-            st.error(f"Unable to display image. Error: {str(e)}")
-            st.write(f"Image URL: {image_url}")
+        # The browser loads the URL itself, so no download happens server side.
+        # A failed load shows as a blank image, so the link stays available
+        st.image(image_url, caption=f"Generated Image {index}", use_column_width=True)
+        st.caption(f"[Open image {index}]({image_url}) if it does not load above")
     
     with col2:
         st.write("**Story Line:**")
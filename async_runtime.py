@@ -0,0 +1,25 @@
+import asyncio
+import concurrent.futures
+import threading
+from typing import Optional
+
+_lock = threading.Lock()
+_loop: Optional[asyncio.AbstractEventLoop] = None
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    # One long-lived loop per process, shared by every session. It lives in
+    # this module rather than st.cache_resource because the rate limiter's
+    # semaphore and llm_cache's in-flight tasks are bound to it, and "Clear
+    # cache" must not swap it out from under them
+    global _loop
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True).start()
+        return _loop
+
+def submit(coro) -> concurrent.futures.Future:
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+
+def run_async(coro):
+    return submit(coro).result()
@@ -0,0 +1,73 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from cachetools import TTLCache
+
+CACHE_PATH = ".llm_cache.sqlite3"
+DEFAULT_TTL = 86400
+MEMORY_MAXSIZE = 64
+MEMORY_TTL = 3600
+
+_lock = threading.Lock()
+_connection: Optional[sqlite3.Connection] = None
+# Hot entries are served from memory before falling back to SQLite
+_memory = TTLCache(maxsize=MEMORY_MAXSIZE, ttl=MEMORY_TTL)
+# Requests currently in progress, keyed like the cache. Living in this module
+# rather than app.py, which Streamlit re-executes on every rerun, it is shared
+# by every session; the tasks all run on the app's single event loop
+inflight: Dict[str, asyncio.Task] = {}
+
+def get_connection() -> sqlite3.Connection:
+    # Opened lazily and kept for the life of the process; this module is
+    # imported once, unlike app.py which Streamlit re-executes on each rerun.
+    # One connection is shared by every session, so access goes through _lock
+    global _connection
+    with _lock:
+        if _connection is None:
+            _connection = sqlite3.connect(CACHE_PATH, check_same_thread=False)
+            _connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            _connection.commit()
+        return _connection
+
+def make_key(model: str, messages: Any) -> str:
+    payload = json.dumps({"model": model, "messages": messages}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def get(key: str) -> Optional[Any]:
+    connection = get_connection()
+    now = time.time()
+    with _lock:
+        # Memory entries carry their row's expiry so they never outlive it
+        entry = _memory.get(key)
+        if entry is not None and entry[1] > now:
+            return entry[0]
+
+        row = connection.execute(
+            "SELECT value, expires_at FROM cache WHERE key = ? AND expires_at > ?",
+            (key, now)
+        ).fetchone()
+        if row is None:
+            return None
+
+        value = json.loads(row[0])
+        _memory[key] = (value, row[1])
+        return value
+
+def set(key: str, value: Any, ttl: int = DEFAULT_TTL):
+    connection = get_connection()
+    expires_at = time.time() + ttl
+    with _lock:
+        connection.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, json.dumps(value), expires_at)
+        )
+        connection.commit()
+        _memory[key] = (value, expires_at)
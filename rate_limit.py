@@ -0,0 +1,78 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+class RateLimitHandler:
+    def __init__(self):
+        self.min_delay = 2
+        self.burst_size = 2
+        self.max_delay = 30
+        self.base_delay = 5
+        self.max_retries = 3
+        self.max_concurrent = 4
+        # Number of calls currently sleeping before a retry; read from the
+        # script thread to tell users why generation has paused
+        self.retries_waiting = 0
+        # Created outside a loop and bound on first use to the shared event loop
+        self.semaphore = asyncio.Semaphore(self.max_concurrent)
+        self._tokens = float(self.burst_size)
+        self._last_refill = time.monotonic()
+        # A threading lock rather than an asyncio one keeps the bucket
+        # independent of any event loop
+        self._lock = threading.Lock()
+
+    async def wait(self):
+        # Token bucket refilled at one request per min_delay. Taking a token may
+        # leave the bucket in debt, which reserves a future slot for this caller
+        # so concurrent callers do not all wake up together
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst_size,
+                self._tokens + (now - self._last_refill) / self.min_delay
+            )
+            self._last_refill = now
+            self._tokens -= 1
+            delay = -self._tokens * self.min_delay if self._tokens < 0 else 0
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def handle_rate_limit(self, attempt: int, retry_after: Optional[float] = None):
+        if attempt >= self.max_retries:
+            raise Exception("Max retries exceeded")
+        
+        # Waiting out a long reset (e.g. a daily quota) would block the
+        # Streamlit run for that long, so give up instead
+        if retry_after is not None and retry_after > self.max_delay:
+            raise Exception(
+                f"Rate limit resets in {retry_after:.0f} seconds, "
+                f"longer than the {self.max_delay} second retry limit"
+            )
+
+        # Trust the server's own estimate when it sends one; otherwise back off
+        if retry_after is not None:
+            delay = retry_after + random.uniform(0, 0.5)
+            source = "Retry-After header"
+        else:
+            delay = min(self.base_delay * (2 ** attempt), self.max_delay)
+            delay += random.uniform(0.1, 2.0)
+            source = "exponential backoff"
+        
+        # Logged rather than shown with st.warning, which st.cache_data would
+        # replay on every later cache hit; the UI polls retries_waiting instead
+        logger.warning("Rate limit hit. Waiting %.2f seconds (%s) before retry...", delay, source)
+        self.retries_waiting += 1
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            self.retries_waiting -= 1
+
+# Kept in an imported module so every rerun and every session shares the same
+# bucket; app.py itself is re-executed by Streamlit on each rerun
+rate_limiter = RateLimitHandler()
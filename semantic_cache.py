@@ -0,0 +1,63 @@
+import logging
+from typing import TYPE_CHECKING
+
+import numpy as np
+import streamlit as st
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+# Kept high so topics that differ in a named character or place are not merged
+SIMILARITY_THRESHOLD = 0.92
+
+# Set once loading the model has failed, so later clicks skip straight to the
+# exact topic instead of retrying a torch import or model download each time
+_model_unavailable = False
+
+@st.cache_resource
+def load_embedding_model() -> "SentenceTransformer":
+    # Imported here so torch is only loaded when the semantic cache is used
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(EMBEDDING_MODEL)
+
+def canonical_topic(topic: str) -> str:
+    # This is only an optimization, so any failure falls back to the topic as
+    # entered and generation goes ahead through the API
+    global _model_unavailable
+    if _model_unavailable:
+        return topic
+
+    try:
+        model = load_embedding_model()
+    except Exception:
+        logger.exception("Could not load the embedding model; semantic cache disabled")
+        _model_unavailable = True
+        return topic
+
+    try:
+        return _match_topic(model, topic)
+    except Exception:
+        logger.exception("Semantic cache lookup failed")
+        return topic
+
+def _match_topic(model: "SentenceTransformer", topic: str) -> str:
+    # Paraphrases of a topic seen earlier in this session resolve to that
+    # topic, so its cached stories are reused instead of calling the API again
+    query = model.encode(topic).astype(np.float32)
+    topics = st.session_state.setdefault("semantic_cache_topics", [])
+    embeddings = st.session_state.setdefault(
+        "semantic_cache_embeddings", np.empty((0, query.shape[0]), dtype=np.float32)
+    )
+
+    if topics:
+        scores = embeddings @ query / (np.linalg.norm(embeddings, axis=1) * np.linalg.norm(query))
+        best = int(np.argmax(scores))
+        if scores[best] > SIMILARITY_THRESHOLD:
+            return topics[best]
+
+    topics.append(topic)
+    st.session_state["semantic_cache_embeddings"] = np.vstack([embeddings, query])
+    return topic